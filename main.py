@@ -5,37 +5,67 @@
 # using PyQt5 and Pymodbus
 # N Laohakunakorn, University of Edinburgh, 2021
 
-import serial 
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
+from PyQt5.QtSerialPort import QSerialPort
 from pyqtgraph import PlotWidget, plot
 import pyqtgraph as pg
 pg.setConfigOption('background','w') # set background default to white
 pg.setConfigOption('antialias',True)
 
-import time, atexit
-from time import sleep
+import atexit
 import numpy as np
-import traceback, sys
-from pymodbus.client.sync import ModbusTcpClient
+import traceback, sys, socket, queue
+import asyncio
+import qasync
+from pymodbus.client.asynchronous.async_io import ReconnectingAsyncioModbusTcpClient, ModbusClientProtocol
 from ctypes import cdll, c_int, c_uint, c_double
 
 ################################################
 ### Configure ethernet communication for Wago
 IP = '192.168.1.3' # Set IP address here
-client = ModbusTcpClient(IP)
 print('IP address of Wago is ', IP)
 
+class WagoProtocol(ModbusClientProtocol):
+    '''asyncio Modbus protocol keeping one long-lived connection:
+    no Nagle delay, keepalive across idle periods
+    '''
+    def connection_made(self, transport):
+        sock = transport.get_extra_info('socket')
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        super(WagoProtocol, self).connection_made(transport)
+
+class WagoSignals(QObject):
+    '''defines signals for Wago connection changes
+    '''
+    connected = pyqtSignal()
+    disconnected = pyqtSignal()
+
+class WagoClient(ReconnectingAsyncioModbusTcpClient):
+    '''reconnecting Modbus client reporting connection changes
+    '''
+    def __init__(self, loop=None):
+        super(WagoClient, self).__init__(protocol_class=WagoProtocol, loop=loop)
+        self.signals = WagoSignals()
+
+    def protocol_made_connection(self, protocol):
+        super(WagoClient, self).protocol_made_connection(protocol)
+        self.signals.connected.emit()
+
+    def protocol_lost_connection(self, protocol):
+        super(WagoClient, self).protocol_lost_connection(protocol)
+        self.signals.disconnected.emit()
+
 ### Configure serial communication for CoolLED
 PORTNAME = 'COM3' # set port name here
-ser = serial.Serial() 
-ser.baudrate = 9600
-ser.port = PORTNAME
-ser.bytesize = 8 
-ser.parity = 'N'
-ser.stopbits = 1
-ser.timeout = 0 # second
+ser = QSerialPort() # driven by the Qt event loop, writes do not block
+ser.setPortName(PORTNAME)
+ser.setBaudRate(QSerialPort.Baud9600)
+ser.setDataBits(QSerialPort.Data8)
+ser.setParity(QSerialPort.NoParity)
+ser.setStopBits(QSerialPort.OneStop)
 ################################################
 
 
@@ -48,6 +78,16 @@ class Madstage():
         # provide valid path to MicroDrive.dll. MicroDrive.h and MicroDrive.lib should also be in the same folder
         path_to_dll = './MicroDrive.dll'
         self.madlib = cdll.LoadLibrary(path_to_dll)
+        # look up and prototype DLL functions once
+        self.mcl_init_handle = self.madlib.MCL_InitHandle
+        self.mcl_init_handle.restype = c_int
+        self.mcl_release_all = self.madlib.MCL_ReleaseAllHandles
+        self.mcl_serial_no = self.madlib.MCL_GetSerialNumber
+        self.mcl_serial_no.argtypes = [c_int]
+        self.mcl_serial_no.restype = c_int
+        self.mcl_movecmd = self.madlib.MCL_MDMove
+        self.mcl_movecmd.argtypes = [c_uint, c_double, c_double, c_int]
+        self.mcl_movecmd.restype = c_int
         self.handler = self.mcl_start()
         atexit.register(self.mcl_close)
     def mcl_start(self):
@@ -56,10 +96,7 @@ class Madstage():
         Return Value:
             Returns a valid handle or returns 0 to indicate failure.
         """
-        mcl_init_handle = self.madlib['MCL_InitHandle']
-        
-        mcl_init_handle.restype = c_int
-        handler = mcl_init_handle()
+        handler = self.mcl_init_handle()
         if(handler==0):
             print("MCL init error")
             return -1
@@ -71,24 +108,19 @@ class Madstage():
         """
         Releases control of all MCL stages controlled by this instance of the DLL.
         """
-        mcl_release_all = self.madlib['MCL_ReleaseAllHandles']
-        mcl_release_all()
+        self.mcl_release_all()
 
     def mcl_serial(self):
         """
         Get serial number
         """
-        mcl_serial_no = self.madlib['MCL_GetSerialNumber']
-        mcl_serial_no.restype = c_int
-        return  mcl_serial_no(c_int(self.handler))
+        return  self.mcl_serial_no(self.handler)
 
     def mcl_move(self,axis,velocity,distance):
         """
         Move axis
         """     
-        mcl_movecmd = self.madlib['MCL_MDMove']
-        mcl_movecmd.restype = c_int
-        return mcl_movecmd(c_uint(axis), c_double(velocity), c_double(distance), c_int(self.handler))
+        return self.mcl_movecmd(axis, velocity, distance, self.handler) # converted per argtypes
 
 ################################################
 # GUI
@@ -134,6 +166,17 @@ class Worker(QRunnable):
 
 class MainWindow(QMainWindow):
 
+    # MCL button position (-X, +Y, -Y, +X) -> (axis, sign of distance)
+    _MCL_ACTION = ((1, 1.0),
+                   (2, -1.0),
+                   (2, 1.0),
+                   (1, -1.0)
+                  )
+
+    # CoolLED commands
+    _LED_ON = b'CSN\n'
+    _LED_OFF = b'CSF\n'
+
     def __init__(self, client, stage, ser, *args, **kwargs):
         super(MainWindow, self).__init__(*args, **kwargs)
 
@@ -141,6 +184,33 @@ class MainWindow(QMainWindow):
         self.setWindowTitle("Microfluidics microscope controller")
         self.setFixedSize(600,800)
 
+        # Asynchronous Modbus client, requests are pipelined on the event loop
+        self.client = client
+        self.client.signals.connected.connect(self.wagoConnected)
+        self.client.signals.disconnected.connect(self.wagoDisconnected)
+
+        # Single-thread pool for blocking MCL calls: keeps them off the GUI thread
+        # and stops moves from interleaving
+        self.io_pool = QThreadPool()
+        self.io_pool.setMaxThreadCount(1)
+        # One long-running worker consumes queued hardware commands
+        self.cmd_q = queue.Queue()
+        self.io_worker = Worker(self._consumer_loop)
+        self.io_worker.signals.result.connect(self.ioComplete)
+        self.io_worker.signals.error.connect(self.ioError)
+        self.io_pool.start(self.io_worker)
+
+        # Debounce manual button toggles into a single coil write
+        self._flushTimer = QTimer(self)
+        self._flushTimer.setSingleShot(True)
+        self._flushTimer.setInterval(50) # ms
+        self._flushTimer.timeout.connect(self.getButtonsState)
+
+        # 24-button state as a bitmask, button 1 in the most significant bit
+        self._state_mask = 0
+        self._last_coils_mask = None # mask confirmed by Wago, None if unknown
+        self._coils_in_flight = 0 # coil writes awaiting a response
+
         self.generalLayout = QVBoxLayout()
         self._centralWidget = QWidget(self)
         self.setCentralWidget(self._centralWidget)
@@ -173,12 +243,30 @@ class MainWindow(QMainWindow):
                    '24': (2, 7)
                   }
 
+        # Fixed patterns used by routines, by letter
+        self._patterns = {}
+
         INPUT = '0000'+'0000'+'0000'+'0000'+'0000'+'0000'
-        self.A = INPUT
+        self._patterns['A'] = INPUT
 
         INPUT = '1111'+'1111'+'1111'+'1111'+'1111'+'1111'
-        self.B = INPUT
+        self._patterns['B'] = INPUT
+
+        INPUT = '1010'+'1010'+'1010'+'1010'+'1010'+'1010'
+        self._patterns['C'] = INPUT
+
+        INPUT = '0101'+'0101'+'0101'+'0101'+'0101'+'0101'
+        self._patterns['D'] = INPUT
 
+        # Patterns never change, so precompute their coil values once
+        # Bit weights for packing button states into a mask, button 1 most significant
+        self._bit_weights = 1 << np.arange(len(buttons)-1, -1, -1, dtype=np.int64)
+        self._coils = {}
+        self._masks = {}
+        for letter, pattern in self._patterns.items():
+            bits = np.frombuffer(pattern.encode('ascii'), dtype=np.uint8) - ord('0')
+            self._coils[letter] = (bits == 0).tolist() #### Inverted as valves are normally open
+            self._masks[letter] = int(bits.dot(self._bit_weights))
 
         self._createDisplayBin()
         self._createButtons(buttons)
@@ -200,6 +288,7 @@ class MainWindow(QMainWindow):
         self._createMCLInput()
         self._createVfield()
         self._createDfield()
+        self._updateMotionCache()
         self.resetMCLButtonsState()
 
         # LED controls
@@ -209,9 +298,10 @@ class MainWindow(QMainWindow):
         self._createLEDButtons(LEDbuttons)
         self.resetLEDButtonsState()
 
+        # Routine state
+        self._routine = None # running routine task
+
         self.show()
-        self.threadpool = QThreadPool()
-        print("Multithreading with maximum %d threads" % self.threadpool.maxThreadCount())
 
         
 
@@ -243,7 +333,7 @@ class MainWindow(QMainWindow):
         self.label = QLabel("Input:")
         self.label.setFixedWidth(120)
         self.k = QLineEdit()
-        self.k.setText(self.A)
+        self.k.setText(self._patterns['A'])
         self.horizonLayout.addWidget(self.label)
         self.horizonLayout.addWidget(self.k)
         self.generalLayout.addLayout(self.horizonLayout)
@@ -270,11 +360,9 @@ class MainWindow(QMainWindow):
     def _createSelectorButtons(self):
         self.horizonLayout = QHBoxLayout()
         self.ll = QPushButton("All on")
-        self.ll.pressed.connect(lambda: self.writeInputCommand(self.B)) # when button pressed, set state
-        self.ll.pressed.connect(self.setButtonsState) # when button pressed, set state
+        self.ll.pressed.connect(lambda: self.applyPattern('B')) # when button pressed, set state
         self.lll = QPushButton("All off")
-        self.lll.pressed.connect(lambda: self.writeInputCommand(self.A)) # when button pressed, set state
-        self.lll.pressed.connect(self.setButtonsState) # when button pressed, set state
+        self.lll.pressed.connect(lambda: self.applyPattern('A')) # when button pressed, set state
         self.horizonLayout.addWidget(self.ll)
         self.horizonLayout.addWidget(self.lll)
         self.generalLayout.addLayout(self.horizonLayout)
@@ -286,9 +374,10 @@ class MainWindow(QMainWindow):
             self.buttons[btnText] = QPushButton(btnText)
             self.buttons[btnText].setFixedSize(60,60)
             self.buttons[btnText].setCheckable(True)
-            self.buttons[btnText].clicked.connect(self.getButtonsState) # when button clicked, get state
+            self.buttons[btnText].clicked.connect(self._scheduleStateFlush) # when button clicked, get state after debounce
             buttonsLayout.addWidget(self.buttons[btnText], pos[0], pos[1])
         self.generalLayout.addLayout(buttonsLayout)
+        self.buttons_seq = tuple(self.buttons[str(i+1)] for i in range(len(self.buttons))) # positional, for hot loops
 
     # For MCL
     def _createMCLInput(self):
@@ -306,6 +395,7 @@ class MainWindow(QMainWindow):
         self.label.setFixedWidth(120)
         self.V = QLineEdit()
         self.V.setText('1')
+        self.V.editingFinished.connect(self._updateMotionCache)
         self.horizonLayout.addWidget(self.label)
         self.horizonLayout.addWidget(self.V)
         self.generalLayout.addLayout(self.horizonLayout)
@@ -316,6 +406,7 @@ class MainWindow(QMainWindow):
         self.label.setFixedWidth(120)
         self.D = QLineEdit()
         self.D.setText('50')
+        self.D.editingFinished.connect(self._updateMotionCache)
         self.horizonLayout.addWidget(self.label)
         self.horizonLayout.addWidget(self.D)
         self.generalLayout.addLayout(self.horizonLayout)
@@ -331,6 +422,7 @@ class MainWindow(QMainWindow):
             self.MCLbuttons[btnText].clicked.connect(self.getMCLButtonsState) # when button clicked, get state
             MCLbuttonsLayout.addWidget(self.MCLbuttons[btnText], pos[0], pos[1])
         self.generalLayout.addLayout(MCLbuttonsLayout)
+        self.MCLbuttons_seq = tuple(self.MCLbuttons.values())
 
     # for LED
     def _createLEDButtons(self,LEDbuttons):
@@ -344,6 +436,7 @@ class MainWindow(QMainWindow):
             self.LEDbuttons[btnText].clicked.connect(self.getLEDButtonsState) # when button clicked, get state
             LEDbuttonsLayout.addWidget(self.LEDbuttons[btnText], pos[0], pos[1])
         self.generalLayout.addLayout(LEDbuttonsLayout)
+        self.LEDbuttons_seq = tuple(self.LEDbuttons.values())
 
 
 
@@ -352,105 +445,155 @@ class MainWindow(QMainWindow):
     # For Wago
 # Must not let multiple routines start in parallel
     def runfunction1(self):
-        worker = Worker(self.executefn1) # instantiate the Runnable subclass
-        worker.signals.result.connect(self.action) # print the output each time a result comes in
-        worker.signals.finished.connect(self.thread_complete) # then run thread complete
-        # Execute
-        self.threadpool.start(worker) # start
+        self.startRoutine(self.executefn1())
     def runfunction2(self):
-        worker = Worker(self.executefn2) # instantiate the Runnable subclass
-        worker.signals.result.connect(self.action) # print the output each time a result comes in
-        worker.signals.finished.connect(self.thread_complete) # then run thread complete
-        # Execute
-        self.threadpool.start(worker) # start
+        self.startRoutine(self.executefn2())
     def runfunction3(self):
-        worker = Worker(self.executefn3) # instantiate the Runnable subclass
-        worker.signals.result.connect(self.action) # print the output each time a result comes in
-        worker.signals.finished.connect(self.thread_complete) # then run thread complete
-        # Execute
-        self.threadpool.start(worker) # start
+        self.startRoutine(self.executefn3())
     def runfunction4(self):
-        worker = Worker(self.executefn4) # instantiate the Runnable subclass
-        worker.signals.result.connect(self.action) # print the output each time a result comes in
-        worker.signals.finished.connect(self.thread_complete) # then run thread complete
-        # Execute
-        self.threadpool.start(worker) # start
+        self.startRoutine(self.executefn4())
+
+    def startRoutine(self,routine):
+        # routine is a coroutine, scheduled as a task on the asyncio/Qt event loop
+        if self._routine is not None:
+            print("Routine already running")
+            routine.close()
+            return
+        self._routine = asyncio.ensure_future(routine)
+        self._routine.add_done_callback(self.routine_complete)
+
+    def stopRoutine(self):
+        if self._routine is not None:
+            self._routine.cancel()
 
     # Experimental routines programmed here
-    def executefn1(self,results):
+    async def executefn1(self):
         for i in range(10):
-            results.emit('A')
-            time.sleep(1)
-            results.emit('B')
-            time.sleep(2)
+            self.action('A')
+            await asyncio.sleep(1)
+            self.action('B')
+            await asyncio.sleep(2)
 
-    def executefn2(self,results):
+    async def executefn2(self):
         for i in range(10):
-            results.emit('A')
-            time.sleep(1)
-            results.emit('B')
-            time.sleep(1)
+            self.action('A')
+            await asyncio.sleep(1)
+            self.action('B')
+            await asyncio.sleep(1)
 
-    def executefn3(self,results):
+    async def executefn3(self):
         for i in range(10):
-            results.emit('B')
-            time.sleep(1)
-            results.emit('A')
-            time.sleep(1)
-            results.emit('B')
-            time.sleep(2)
-
-    def executefn4(self,results):
+            self.action('B')
+            await asyncio.sleep(1)
+            self.action('A')
+            await asyncio.sleep(1)
+            self.action('B')
+            await asyncio.sleep(2)
+
+    async def executefn4(self):
         for i in range(10):
-            results.emit('A')
-            time.sleep(0.5)
-            results.emit('B')
-            time.sleep(0.5)
-            results.emit('A')
-            time.sleep(0.5)
-            results.emit('B')
-            time.sleep(1)
-
-    def thread_complete(self):
-        print("Thread complete!")
+            self.action('A')
+            await asyncio.sleep(0.5)
+            self.action('B')
+            await asyncio.sleep(0.5)
+            self.action('A')
+            await asyncio.sleep(0.5)
+            self.action('B')
+            await asyncio.sleep(1)
+
+    def routine_complete(self,task):
+        self._routine = None
+        if task.cancelled():
+            print("Routine cancelled")
+        elif task.exception() is not None:
+            print("Routine failed:", repr(task.exception()))
+        else:
+            print("Routine complete!")
 
     # Commands programmed here
     def action(self,results):
         if results:
             self.bc.setText(results) # update text box
-            self.writeInputCommand(eval('self.'+results))
-            self.setButtonsState()
-
+            self.applyPattern(results)
+
+    def applyPattern(self,letter):
+        # set input, display, buttons and Wago coils from a precomputed pattern in one pass
+        text = self._patterns[letter]
+        coils = self._coils[letter]
+        self.writeInputCommand(text)
+        self.displayBin.setText(text)
+        self._state_mask = self._masks[letter]
+        self.setCheckedStates(self.buttons_seq, [not coil for coil in coils])
+        self.setCoils(coils, self._state_mask)
+
+    def _scheduleStateFlush(self):
+        # (re)start debounce timer; getButtonsState runs once clicks stop
+        self._flushTimer.start()
 
     def getButtonsState(self):
-        # read state of buttons and display bin/Hex
-        state = []
-        for btnText, pos in self.buttons.items():
-            state.append(int(self.buttons[btnText].isChecked()))
-        binstring = ''.join(['1' if x else '0' for x in state])
-        self.displayBin.setText(binstring)
+        # click handler: write state and move focus to the display
+        self.writeButtonsState()
         self.displayBin.setFocus()
-        self.b4.setText('OK')
+
+    def writeButtonsState(self):
+        # read state of buttons, display bin/Hex and write to Wago
+        state = np.array([btn.isChecked() for btn in self.buttons_seq], dtype=bool)
+        binstring = (state.view(np.uint8) + ord('0')).tobytes().decode('ascii')
+        self._state_mask = int(state.dot(self._bit_weights))
+        self.displayBin.setText(binstring)
 
         # Write command to Wago
-        INPUT = binstring 
-        for j in range(len(INPUT)):
-            status = not(bool(int(INPUT[j]))) #### Invert booleans as valves are normally open
-            client.write_coil(j, status)
+        status = (~state).tolist() #### Invert booleans as valves are normally open
+        self._last_coils_mask = None # manual edit, always write
+        self.setCoils(status, self._state_mask)
+
+    def setCoils(self,coils,mask):
+        # write all coils to Wago in a single request (FC15), skipped if confirmed in this state
+        if mask == self._last_coils_mask and self._coils_in_flight == 0:
+            return
+        self._coils_in_flight += 1
+        asyncio.ensure_future(self._writeCoils(coils, mask))
+
+    async def _writeCoils(self,coils,mask):
+        # several writes can be in flight at once, responses are matched by transaction id
+        ok = False
+        try:
+            if self.client.protocol is None:
+                result = 'Wago not connected'
+            else:
+                result = await self.client.protocol.write_coils(0, coils)
+                ok = not result.isError()
+        except Exception as e:
+            result = e
+        finally:
+            self._coils_in_flight -= 1
+        if ok:
+            self._last_coils_mask = mask # only cached once the Wago has confirmed it
+            self.b4.setText('OK')
+        else:
+            self._last_coils_mask = None # coil state unknown, next write must go through
+            self.ioError(result)
+
+    def wagoConnected(self):
+        # runs on every (re)connection: PLC may have restarted, so push current state
+        self._last_coils_mask = None
+        self.writeButtonsState() # no focus change, user may be typing
+
+    def wagoDisconnected(self):
+        self._last_coils_mask = None # coil state unknown until reconnected
+        self.b4.setText('Error! Wago disconnected')
 
 
 # Must do proper error checking here
     def setButtonsState(self):
         # set buttons according to state specified in k
         inputs = self.k.text()
-        if len(inputs)!=24:
+        bits = np.frombuffer(inputs.encode('ascii', 'replace'), dtype=np.uint8) - ord('0') # anything but 0/1 wraps above 1
+        if len(bits)!=len(self.buttons_seq) or (bits > 1).any():
             self.b4.setText('Error! Require 24-bit binary input')
-            self.k.setText(self.A)
+            self.k.setText(self._patterns['A'])
         else:
-            j = 0
-            for btnText, pos in self.buttons.items():
-                self.buttons[btnText].setChecked(bool(int(inputs[j]))) 
-                j+=1
+            self.setCheckedStates(self.buttons_seq, [bool(bit) for bit in bits.tolist()])
             self.getButtonsState()
             self.b4.setText('OK')
 
@@ -459,97 +602,156 @@ class MainWindow(QMainWindow):
         self.k.setText(inputs)
 
 
+    # For hardware I/O
+    def startIO(self, fn, *args):
+        # queue blocking call fn(*args) for the I/O thread, result reported to status field
+        self.cmd_q.put((fn, args))
+
+    def stopIO(self):
+        # let pending hardware commands finish, then end the consumer
+        self.cmd_q.put(None)
+        self.io_pool.waitForDone()
+
+    def _consumer_loop(self, results):
+        # runs on the I/O thread until stopIO
+        while True:
+            cmd = self.cmd_q.get()
+            if cmd is None:
+                return
+            fn, args = cmd
+            try:
+                results.emit(fn(*args))
+            except Exception as e:
+                traceback.print_exc()
+                results.emit(e)
+
+    def ioComplete(self, result):
+        if isinstance(result, Exception):
+            self.ioError(result)
+        elif isinstance(result, int) and result < 0: # MicroDrive error code, e.g. -5 device not ready
+            print('MCL error', result)
+            self.b4.setText('Error! MCL code %d' % result)
+        else:
+            self.b4.setText('OK')
+
+    def ioError(self, error):
+        self.b4.setText('Error')
+
+    def writeSerial(self, data):
+        # QSerialPort lives on the GUI thread and buffers writes, so call it directly
+        if ser.write(data) == -1:
+            self.b4.setText('Error')
+        else:
+            ser.flush()
+            self.b4.setText('OK')
+
+
     # For MCL
 
     def getMCLButtonsState(self):
         # read state of buttons and trigger actions
-        state = []
-        for btnText, pos in self.MCLbuttons.items():
-            state.append(int(self.MCLbuttons[btnText].isChecked()))
-        binstring = ''.join(['1' if x else '0' for x in state])
-        self.MCL.setText(binstring)
+        pressed = next((i for i, btn in enumerate(self.MCLbuttons_seq) if btn.isChecked()), None)
+        if pressed is not None:
+            self.MCL.setText(self.MCLbuttons_seq[pressed].text())
 
         # Write command
-        INPUT = binstring 
-        self.move(INPUT)
+        self.move(pressed)
         self.resetMCLButtonsState() # reset all buttons
         
     def resetMCLButtonsState(self):
-        for btnText, pos in self.MCLbuttons.items():
-                self.MCLbuttons[btnText].setChecked(False)
-
-    def move(self,INPUT):
-#       -X = 1000 -> +M1
-#       +X = 0001 -> -M1
-#       -Y = 0010 -> +M2
-#       +Y = 0100 -> -M2
-
-        if INPUT == '1000':
-            axis = 1
-            distance = float(self.D.text())*(1/1000) # convert to mm
-        elif INPUT == '0001':
-            axis = 1
-            distance = -float(self.D.text())*(1/1000) # convert to mm
-        elif INPUT == '0100':
-            axis = 2
-            distance = -float(self.D.text())*(1/1000) # convert to mm
-        elif INPUT == '0010':
-            axis = 2
-            distance = float(self.D.text())*(1/1000) # convert to mm
-        velocity = float(self.V.text())       
-        stage.mcl_move(axis,velocity,distance)
-        print('Move', axis, velocity, distance)
+        self.setCheckedStates(self.MCLbuttons_seq, [False]*len(self.MCLbuttons_seq))
+
+    def _updateMotionCache(self):
+        # parse velocity and distance once per edit rather than on every move
+        try:
+            v = float(self.V.text())
+            d_mm = float(self.D.text())*0.001 # convert to mm
+        except ValueError:
+            self._motion_valid = False
+            self.b4.setText('Error! Velocity and distance must be numbers')
+            return
+        self._v = v
+        self._d_mm = d_mm
+        self._motion_valid = True
+
+    def move(self,pressed):
+#       -X -> +M1
+#       +X -> -M1
+#       -Y -> +M2
+#       +Y -> -M2
+
+        if pressed is None: # no direction selected
+            return
+        if not self._motion_valid: # never move with stale parameters
+            self.b4.setText('Error! Velocity and distance must be numbers')
+            return
+        axis, sign = self._MCL_ACTION[pressed]
+        distance = sign*self._d_mm
+        self.startIO(stage.mcl_move, axis, self._v, distance)
+        print('Move', axis, self._v, distance)
 
 
     # For LED
 
     def getLEDButtonsState(self):
         # read state of buttons and trigger actions
-        state = []
-        for btnText, pos in self.LEDbuttons.items():
-            state.append(int(self.LEDbuttons[btnText].isChecked()))
-        binstring = ''.join(['1' if x else '0' for x in state])
-
         # Write command
-        INPUT = binstring 
-        if bool(int(INPUT)):
+        if self.LEDbuttons['LED ON'].isChecked():
             print('LED on')
-            CMD = 'CSN\n'
-            ser.write(CMD.encode())
+            self.writeSerial(self._LED_ON)
         else:
             print('LED off')
-            CMD = 'CSF\n'
-            ser.write(CMD.encode())
+            self.writeSerial(self._LED_OFF)
      
     def resetLEDButtonsState(self):
-        for btnText, pos in self.LEDbuttons.items():
-                self.LEDbuttons[btnText].setChecked(False)
+        self.setCheckedStates(self.LEDbuttons_seq, [False]*len(self.LEDbuttons_seq))
+
+    # For all buttons
+    def setCheckedStates(self,buttons,states):
+        # set checked states with signals blocked and a single repaint at the end
+        blockers = [QSignalBlocker(btn) for btn in buttons]
+        self._centralWidget.setUpdatesEnabled(False)
+        for btn, state in zip(buttons, states):
+            btn.setChecked(state)
+        self._centralWidget.setUpdatesEnabled(True)
+        self._centralWidget.update()
+        for blocker in blockers:
+            blocker.unblock()
 
 def handle_exit():
 #   carry out exit functions here
-    ser.close()
-    print('Port closed')
     print('Exiting')
 
-def main(client,stage,ser):
+def main(stage,ser):
 
 #   Startup items here
     print('Starting Wago')
 
-    # Open port
-    ser.open()
-    print('Serial port open')
-
 #   Exit items here
     atexit.register(handle_exit)
 
-    # here is the app running
+    # here is the app running, Qt event loop doubles as the asyncio loop
     app = QApplication(sys.argv)
+    loop = qasync.QEventLoop(app)
+    asyncio.set_event_loop(loop)
+
+    # Open port, needs the QApplication event dispatcher
+    if ser.open(QIODevice.ReadWrite):
+        print('Serial port open')
+    else:
+        print('Could not open serial port', ser.errorString())
+
+    client = WagoClient(loop=loop)
 
     window = MainWindow(client,stage,ser)
     window.show()
+    asyncio.ensure_future(client.start(IP)) # reconnects in the background on failure
+    app.aboutToQuit.connect(client.stop)
+    app.aboutToQuit.connect(window.stopRoutine)
+    app.aboutToQuit.connect(window.stopIO) # let pending hardware writes finish
 
-    sys.exit(app.exec_())
+    with loop:
+        loop.run_forever()
 
 
 if __name__=='__main__':
@@ -559,4 +761,4 @@ if __name__=='__main__':
     # intialize
     stage = Madstage()
     print(stage.mcl_serial()) # get serial number
-    main(client,stage,ser)
+    main(stage,ser)